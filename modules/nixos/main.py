@@ -9,6 +9,8 @@
 #
 
 import libcalamares
+import functools
+import json
 import os
 import subprocess
 import re
@@ -172,7 +174,23 @@ cfgbootbios = """  # Bootloader.
 
 """
 
-cfgbootbase = """  # Clean /tmp on reboot
+# Kernel command line used with both the EFI and the BIOS bootloader.
+kernelparams = (
+    "quiet",
+    "splash",
+    "boot.shell_on_fail",
+    "nvidia_drm.modeset=1",
+    "nvidia_drm.fbdev=1",
+    "loglevel=3",
+    "rd.systemd.show_status=false",
+    "rd.udev.log_level=3",
+    "udev.log_priority=3",
+    "sysrq_always_enabled=1",
+    "usbcore.autosuspend=-1",
+)
+
+cfgbootbase = (
+    """  # Clean /tmp on reboot
   boot.tmp = {
     cleanOnBoot = true;
     useTmpfs = true;
@@ -197,18 +215,9 @@ cfgbootbase = """  # Clean /tmp on reboot
   boot.blacklistedKernelModules = [ "nouveau" ];
   boot.plymouth.enable = true;
   boot.kernelParams = [
-    "quiet"
-    "splash"
-    "boot.shell_on_fail"
-    "nvidia_drm.modeset=1"
-    "nvidia_drm.fbdev=1"
-    "loglevel=3"
-    "rd.systemd.show_status=false"
-    "rd.udev.log_level=3"
-    "udev.log_priority=3"
-    "sysrq_always_enabled=1"
-    "usbcore.autosuspend=\"-1\";
-  ];
+"""
+    + "".join('    "{}"\n'.format(param) for param in kernelparams)
+    + """  ];
 
   boot.extraModulePackages = [ config.boot.kernelPackages.nvidiaPackages.beta ];
 
@@ -226,9 +235,7 @@ cfgbootbase = """  # Clean /tmp on reboot
   ];
 
 """
-
-cfgbootefi += cfgbootbase
-cfgbootbios += cfgbootbase
+)
 
 cfgbootnone = """  # Disable bootloader.
   boot.loader.grub.enable = false;
@@ -1237,7 +1244,18 @@ cfgtail = """  # PAM configuration
   };
 
   # System-wide shell config
-  environment.etc.bashrc.text = ''
+  environment.etc.bashrc.text =
+    let
+      # Impacket aliases, generated once at build time instead of
+      # looping over the scripts in every new shell
+      impacketAliases = pkgs.runCommand "impacket-aliases" { } ''
+        for script in ${pkgs.python3Packages.impacket}/bin/*; do
+          name=''${script##*/}
+          echo "alias impacket-''${name%%.*}='$script'"
+        done > $out
+      '';
+    in
+    ''
     # Create /opt if it doesn't already exist and set proper permissions on it
     if [ ! -d /opt ]; then
       if [ $UID -eq 0 ]; then
@@ -1250,7 +1268,6 @@ cfgtail = """  # PAM configuration
     fi
 
     # Ensure that Rust is installed in the correct (sysmtem-wide) location
-    export CARGO_BUILD_JOBS=$(nproc)
     export RUSTUP_HOME=/opt/rust
     export CARGO_HOME=/opt/rust
 
@@ -1264,22 +1281,43 @@ cfgtail = """  # PAM configuration
     # Allow editing of files as root
     alias pkexec="pkexec env DISPLAY=$DISPLAY XAUTHORITY=$XAUTHORITY KDE_SESSION_VERSION=6 KDE_FULL_SESSION=true"
 
+    # Prompt colours, wrapped in \\001/\\002 so readline knows they take no space
+    __g=$'\\001\\e[1;32m\\002' __b=$'\\001\\e[1;34m\\002' __w=$'\\001\\e[1;37m\\002'
+    __y=$'\\001\\e[1;33m\\002' __r=$'\\001\\e[0m\\002'
+
+    # Refresh the VPN details shown in the prompt at most every 5 seconds
+    # instead of running the /etc/htb scripts for every prompt
+    __htb_vpn() {
+      local now
+      printf -v now '%(%s)T' -1
+      if (( now - __htb_vpn_time >= 5 )); then
+        __htb_ip=$(/etc/htb/vpnbash.sh)
+        __htb_srv=$(/etc/htb/vpnserver.sh)
+        __htb_vpn_time=$now
+        if [[ $__htb_ip == *"10."* ]]; then
+          __htb_vpn_ps1="[$__b$__htb_srv$__g]─[$__w$__htb_ip$__g]─"
+        else
+          __htb_vpn_ps1=
+        fi
+      fi
+    }
+    [[ $PROMPT_COMMAND == *__htb_vpn* ]] || PROMPT_COMMAND="__htb_vpn''${PROMPT_COMMAND:+; $PROMPT_COMMAND}"
+
     #PwnBox-style shell prompt
-    PS1="\[\033[1;32m\]\342\224\214\342\224\200\$([[ \$(/etc/htb/vpnbash.sh) == *\"10.\"* ]] && echo \"[\[\033[1;34m\]\$(/etc/htb/vpnserver.sh)\[\033[1;32m\]]\342\224\200[\[\033[1;37m\]\$(/etc/htb/vpnbash.sh)\[\033[1;32m\]]\342\224\200\")[\[\033[1;37m\]\u\[\033[01;32m\]@\[\033[01;34m\]\h\[\033[1;32m\]]\342\224\200[\[\033[1;37m\]\w\[\033[1;32m\]]\n\[\033[1;32m\]\342\224\224\342\224\200\342\224\200\342\225\274 [\[\e[01;33m\]★\[\e[01;32m\]]\\$ \[\e[0m\]"
+    PS1='$__g┌─$__htb_vpn_ps1[''${__w}\\u$__g@''${__b}\\h$__g]─[$__w\\w$__g]\\n$__g└──╼ [$__y★$__g]\\$ $__r'
 
     # Fix Internet connection
-    if [ "$(ip link | grep enp4s0 | cut -d' ' -f9)" == "DOWN" ]
+    if [ "$(ip -br link show enp4s0 2>/dev/null | awk '{ print $2 }')" == "DOWN" ]
     then
-      connection=$(nmcli c show | grep enp4s0 | cut -d' ' -f1)
-
-      sudo ip link set dev enp4s0 up
-      nmcli c "$connection" up
-
-      while [ $? -ne 0 ]
+      # Retry a few times with a pause in between instead of spinning
+      for attempt in 1 2 3 4 5
       do
-        sudo ip link set dev enp4s0 up
-        nmcli c "$connection" up
+        sudo ip link set dev enp4s0 up && nmcli d connect enp4s0 && break
+        sleep 2
       done
+
+      # Let NetworkManager report when the network is actually usable
+      nm-online -s -q --timeout=10 || true
     fi
 
     # Alias BeEF to start script
@@ -1290,10 +1328,7 @@ cfgtail = """  # PAM configuration
     alias nixos-upgrade="sudo nixos-rebuild switch --upgrade && sudo nix-collect-garbage -d"
 
     # Impacket aliases to ease transition from Parrot/Kali
-    for script in ${pkgs.python3Packages.impacket}/bin/*
-    do
-      alias impacket-$(echo $script | cut -d'/' -f6 | cut -d'.' -f1)="$script"
-    done
+    source ${impacketAliases}
 
     # Make it easier to use arrow keys inside reverse shells
     alias nc="sudo rlwrap ncat"
@@ -1303,13 +1338,13 @@ cfgtail = """  # PAM configuration
   environment.etc."htb/vpnserver.sh".text = ''
     #!${pkgs.bash}/bin/bash
 
-    nmcli c show | grep vpn | grep academy | cut -d' ' -f1
+    nmcli -t -f NAME,TYPE c show | awk -F: '/vpn/ && /academy/ { print $1; exit }'
   '';
 
   # VPN IP address
   environment.etc."htb/vpnbash.sh".text = ''
     #!${pkgs.bash}/bin/bash
-    htbip=$(ip addr | grep tun | grep inet | grep -E "(10\.10|10\.129)" | tr -s " " | cut -d " " -f 3 | cut -d "/" -f 1)
+    htbip=$(ip -o -4 addr show | awk '/tun/ && / 10\\.(10|129)\\./ { split($4, addr, "/"); print addr[1]; exit }')
 
     if [[ $htbip == *"10."* ]]
     then
@@ -1409,15 +1444,47 @@ cfgtail = """  # PAM configuration
           command = "konsole";
         };
 
-        input.mice =  [
-          {
-            acceleration = 1.0;
-            accelerationProfile = "none";
-            name = builtins.readFile (pkgs.runCommand "mousename" { } "grep -B1 -A9 'Mouse' /proc/bus/input/devices | grep 'Name' | cut -d\= -f2 | cut -d'\"' -f2 > $out");
-            vendorId = builtins.readFile (pkgs.runCommand "vendor" { } "grep -B1 -A9 'Mouse' /proc/bus/input/devices | grep 'I:' | tr ' ' '\n' | grep -v 'I:' | grep -v 'Bus' | grep -v 'Version' | cut -d\= -f2 | head -n1 | tr -d '\n' > $out");
-            productId = builtins.readFile (pkgs.runCommand "product" { } "grep -B1 -A9 'Mouse' /proc/bus/input/devices | grep 'I:' | tr ' ' '\n' | grep -v 'I:' | grep -v 'Bus' | grep -v 'Version' | cut -d\= -f2 | tail -n1 | tr -d '\n' > $out");
-          }
-        ];
+        # Probe /proc/bus/input/devices once for the first mouse and keep
+        # its name, vendor and product IDs as separate files
+        input.mice =
+          let
+            mouseInfo = pkgs.runCommand "mouseinfo" { } ''
+              mkdir -p $out
+              awk -v out="$out" '
+                BEGIN { RS = ""; FS = "\\n" }
+                /Mouse/ {
+                  for (i = 1; i <= NF; i++) {
+                    if ($i ~ /^N: Name=/) {
+                      name = $i
+                      sub(/^N: Name="/, "", name)
+                      sub(/"$/, "", name)
+                    } else if ($i ~ /^I: /) {
+                      n = split($i, fields, " ")
+                      for (j = 2; j <= n; j++) {
+                        split(fields[j], kv, "=")
+                        id[kv[1]] = kv[2]
+                      }
+                    }
+                  }
+                  exit
+                }
+                END {
+                  printf "%s", name > (out "/name")
+                  printf "%s", id["Vendor"] > (out "/vendor")
+                  printf "%s", id["Product"] > (out "/product")
+                }
+              ' /proc/bus/input/devices
+            '';
+          in
+          [
+            {
+              acceleration = 1.0;
+              accelerationProfile = "none";
+              name = builtins.readFile "${mouseInfo}/name";
+              vendorId = builtins.readFile "${mouseInfo}/vendor";
+              productId = builtins.readFile "${mouseInfo}/product";
+            }
+          ];
 
         panels = [
 
@@ -1592,22 +1659,17 @@ cfgtail = """  # PAM configuration
   system.stateVersion = "@@nixosversion@@";
 }
 """
-def env_is_set(name):
-    envValue = os.environ.get(name)
-    return not (envValue is None or envValue == "")
+proxy_variables = ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY")
+
 
 def generateProxyStrings():
     proxyEnv = []
-    if env_is_set('http_proxy'):
-        proxyEnv.append('http_proxy={}'.format(os.environ.get('http_proxy')))
-    if env_is_set('https_proxy'):
-        proxyEnv.append('https_proxy={}'.format(os.environ.get('https_proxy')))
-    if env_is_set('HTTP_PROXY'):
-        proxyEnv.append('HTTP_PROXY={}'.format(os.environ.get('HTTP_PROXY')))
-    if env_is_set('HTTPS_PROXY'):
-        proxyEnv.append('HTTPS_PROXY={}'.format(os.environ.get('HTTPS_PROXY')))
-
-    if len(proxyEnv) > 0:
+    for name in proxy_variables:
+        value = os.environ.get(name)
+        if value:
+            proxyEnv.append("{}={}".format(name, value))
+
+    if proxyEnv:
         proxyEnv.insert(0, "env")
 
     return proxyEnv
@@ -1636,6 +1698,145 @@ def catenate(d, key, *values):
     d[key] = "".join(values)
 
 
+variable_pattern = re.compile(r"@@(\w+)@@")
+
+extra_module_packages_pattern = re.compile(
+    r"boot\.extraModulePackages = \[ (.*) \];"
+)
+
+# Values of a partition's "fsName" that mean it is a LUKS container.
+luks_filesystems = frozenset(("luks", "luks2"))
+
+
+def render(template, variables):
+    """
+    Replaces every @@key@@ placeholder in @p template with
+    the value of @p variables[key] in a single pass.
+    Placeholders without a value are left untouched. Both those
+    and variables that are never used are reported as warnings.
+    """
+    used = set()
+
+    def substitute(match):
+        key = match.group(1)
+        if key not in variables:
+            libcalamares.utils.warning(
+                "Variable '{key}' is used but not defined.".format(key=key)
+            )
+            return match.group(0)
+        used.add(key)
+        return str(variables[key])
+
+    text = variable_pattern.sub(substitute, template)
+
+    for key in variables.keys():
+        if key not in used:
+            libcalamares.utils.warning("Variable '{key}' is not used.".format(key=key))
+
+    return text
+
+
+def unfree_kernel_packages(packages):
+    """
+    Asks nixpkgs which of the kernel module @p packages are unfree.
+    All packages are checked with a single nix-instantiate call.
+    Returns a dict mapping each package name to True if it is unfree.
+    """
+    expression = "with import <nixpkgs> {{}}; {{ {} }}".format(
+        " ".join(
+            '"{0}" = pkgs.linuxKernel.packageAliases.linux_default.{0}.meta.unfree or false;'.format(
+                p
+            )
+            for p in packages
+        )
+    )
+    output = subprocess.check_output(
+        ["nix-instantiate", "--eval", "--strict", "-E", expression, "--json"]
+    )
+    return json.loads(output)
+
+
+def luks_uses_pbkdf2(device, fs_name):
+    """
+    Checks whether every key slot of the LUKS @p device already
+    uses pbkdf2, in which case there is nothing to convert.
+    LUKS1 (@p fs_name "luks") only has pbkdf2 key slots. Returns
+    False if a LUKS2 header cannot be dumped, so it gets converted.
+    """
+    if fs_name == "luks":
+        return True
+
+    try:
+        metadata = subprocess.check_output(
+            ["cryptsetup", "luksDump", "--dump-json-metadata", device],
+            stderr=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        return False
+
+    keyslots = json.loads(metadata).get("keyslots", {})
+    return all(
+        keyslot.get("kdf", {}).get("type") == "pbkdf2"
+        for keyslot in keyslots.values()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def console_keymaps():
+    """
+    Returns the set of console keymaps known to the live system,
+    or None if `localectl list-keymaps` cannot be run. The list
+    is only fetched once.
+    """
+    try:
+        keymaps = subprocess.check_output(
+            ["localectl", "list-keymaps"], stderr=subprocess.DEVNULL, text=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return frozenset(keymaps.split())
+
+
+def keymap_is_valid(keymap):
+    """
+    Checks whether the console @p keymap exists. Without localectl,
+    falls back to test-loading it with loadkeys.
+    """
+    keymaps = console_keymaps()
+    if keymaps is not None:
+        return keymap in keymaps
+
+    try:
+        subprocess.check_output(
+            ["pkexec", "loadkeys", keymap], stderr=subprocess.STDOUT
+        )
+    except subprocess.CalledProcessError as e:
+        libcalamares.utils.error("loadkeys: {}".format(e.output))
+        return False
+
+    return True
+
+
+def write_file(path, data, mode=0o644):
+    """
+    Writes @p data to @p path, replacing any previous contents,
+    and sets the file's permissions to @p mode. Text is encoded
+    as UTF-8. The data is written straight to the file descriptor,
+    without going through a helper process.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    data = memoryview(data)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.fchmod(fd, mode)
+        while data:
+            data = data[os.write(fd, data) :]
+    finally:
+        os.close(fd)
+
+
 def run():
     """NixOS Configuration."""
 
@@ -1644,7 +1845,7 @@ def run():
     libcalamares.job.setprogress(0.1)
 
     # Create initial config file
-    cfg = cfghead
+    cfg_parts = [cfghead]
     gs = libcalamares.globalstorage
     variables = dict()
 
@@ -1652,95 +1853,87 @@ def run():
     root_mount_point = gs.value("rootMountPoint")
     config = os.path.join(root_mount_point, "etc/nixos/configuration.nix")
     fw_type = gs.value("firmwareType")
-    bootdev = (
-        "nodev"
-        if gs.value("bootLoader") is None
-        else gs.value("bootLoader")["installPath"]
-    )
+    bootloader = gs.value("bootLoader")
+    bootdev = "nodev" if bootloader is None else bootloader["installPath"]
 
     # Pick config parts and prepare substitution
 
     # Check bootloader
     if fw_type == "efi":
-        cfg += cfgbootefi
+        cfg_parts.append(cfgbootefi)
+        cfg_parts.append(cfgbootbase)
     elif bootdev != "nodev":
-        cfg += cfgbootbios
+        cfg_parts.append(cfgbootbios)
+        cfg_parts.append(cfgbootbase)
         catenate(variables, "bootdev", bootdev)
     else:
-        cfg += cfgbootnone
+        cfg_parts.append(cfgbootnone)
 
-    # Setup encrypted swap devices. nixos-generate-config doesn't seem to notice them.
+    # Find / and /boot and collect the LUKS devices in a single pass.
+    # If two partitions share a mount point the last one wins.
+    root = None
+    boot = None
+    luks_partitions = []
     for part in gs.value("partitions"):
+        if part["mountPoint"] == "/":
+            root = part
+        elif part["mountPoint"] == "/boot":
+            boot = part
         if (
             part["claimed"] is True
-            and (part["fsName"] == "luks" or part["fsName"] == "luks2")
+            and part["fsName"] in luks_filesystems
             and part["device"] is not None
-            and part["fs"] == "linuxswap"
         ):
-            cfg += """  boot.initrd.luks.devices."{}".device = "/dev/disk/by-uuid/{}";\n""".format(
-                part["luksMapperName"], part["uuid"]
+            luks_partitions.append(part)
+
+    # Setup encrypted swap devices. nixos-generate-config doesn't seem to notice them.
+    for part in luks_partitions:
+        if part["fs"] == "linuxswap":
+            cfg_parts.append(
+                """  boot.initrd.luks.devices."{}".device = "/dev/disk/by-uuid/{}";\n""".format(
+                    part["luksMapperName"], part["uuid"]
+                )
             )
 
     # Check partitions
-    root_is_encrypted = False
-    boot_is_encrypted = False
-    boot_is_partition = False
-
-    for part in gs.value("partitions"):
-        if part["mountPoint"] == "/":
-            root_is_encrypted = part["fsName"] in ["luks", "luks2"]
-        elif part["mountPoint"] == "/boot":
-            boot_is_partition = True
-            boot_is_encrypted = part["fsName"] in ["luks", "luks2"]
+    root_is_encrypted = root is not None and root["fsName"] in luks_filesystems
+    boot_is_partition = boot is not None
+    boot_is_encrypted = boot_is_partition and boot["fsName"] in luks_filesystems
 
     # Setup keys in /boot/crypto_keyfile if using BIOS and Grub cryptodisk
     if fw_type != "efi" and (
         (boot_is_partition and boot_is_encrypted)
         or (root_is_encrypted and not boot_is_partition)
     ):
-        cfg += cfgbootgrubcrypt
+        cfg_parts.append(cfgbootgrubcrypt)
         status = _("Setting up LUKS")
         libcalamares.job.setprogress(0.15)
         try:
-            libcalamares.utils.host_env_process_output(
-                ["mkdir", "-p", root_mount_point + "/boot"], None
-            )
-            libcalamares.utils.host_env_process_output(
-                ["chmod", "0700", root_mount_point + "/boot"], None
+            # Create /boot (or tighten an existing one) with mode 0700
+            os.makedirs(root_mount_point + "/boot", mode=0o700, exist_ok=True)
+            os.chmod(root_mount_point + "/boot", 0o700)
+            # Create /boot/crypto_keyfile.bin from the kernel CSPRNG
+            write_file(
+                root_mount_point + "/boot/crypto_keyfile.bin",
+                os.urandom(2048),
+                0o600,
             )
-            # Create /boot/crypto_keyfile.bin
-            libcalamares.utils.host_env_process_output(
-                [
-                    "dd",
-                    "bs=512",
-                    "count=4",
-                    "if=/dev/random",
-                    "of=" + root_mount_point + "/boot/crypto_keyfile.bin",
-                    "iflag=fullblock",
-                ],
-                None,
-            )
-            libcalamares.utils.host_env_process_output(
-                ["chmod", "600", root_mount_point + "/boot/crypto_keyfile.bin"], None
-            )
-        except subprocess.CalledProcessError:
+        except OSError:
             libcalamares.utils.error("Failed to create /boot/crypto_keyfile.bin")
             return (
                 _("Failed to create /boot/crypto_keyfile.bin"),
                 _("Check if you have enough free space on your partition."),
             )
 
-        for part in gs.value("partitions"):
-            if (
-                part["claimed"] is True
-                and (part["fsName"] == "luks" or part["fsName"] == "luks2")
-                and part["device"] is not None
-            ):
-                cfg += """  boot.initrd.luks.devices."{}".keyFile = "/boot/crypto_keyfile.bin";\n""".format(
+        for part in luks_partitions:
+            cfg_parts.append(
+                """  boot.initrd.luks.devices."{}".keyFile = "/boot/crypto_keyfile.bin";\n""".format(
                     part["luksMapperName"]
                 )
-                try:
-                    # Grub currently only supports pbkdf2 for luks2
+            )
+            try:
+                # Grub currently only supports pbkdf2 for luks2
+                if not luks_uses_pbkdf2(part["device"], part["fsName"]):
                     libcalamares.utils.host_env_process_output(
                         [
                             "cryptsetup",
@@ -1754,189 +1947,158 @@ def run():
                         None,
                         part["luksPassphrase"],
                     )
-                    # Add luks drives to /boot/crypto_keyfile.bin
-                    libcalamares.utils.host_env_process_output(
-                        [
-                            "cryptsetup",
-                            "luksAddKey",
-                            "--hash",
-                            "sha256",
-                            "--pbkdf",
-                            "pbkdf2",
-                            part["device"],
-                            root_mount_point + "/boot/crypto_keyfile.bin",
-                        ],
-                        None,
-                        part["luksPassphrase"],
+                # Add luks drives to /boot/crypto_keyfile.bin
+                libcalamares.utils.host_env_process_output(
+                    [
+                        "cryptsetup",
+                        "luksAddKey",
+                        "--hash",
+                        "sha256",
+                        "--pbkdf",
+                        "pbkdf2",
+                        part["device"],
+                        root_mount_point + "/boot/crypto_keyfile.bin",
+                    ],
+                    None,
+                    part["luksPassphrase"],
+                )
+            except subprocess.CalledProcessError:
+                libcalamares.utils.error(
+                    "Failed to add {} to /boot/crypto_keyfile.bin".format(
+                        part["luksMapperName"]
                     )
-                except subprocess.CalledProcessError:
-                    libcalamares.utils.error(
+                )
+                return (
+                    _("cryptsetup failed"),
+                    _(
                         "Failed to add {} to /boot/crypto_keyfile.bin".format(
                             part["luksMapperName"]
                         )
-                    )
-                    return (
-                        _("cryptsetup failed"),
-                        _(
-                            "Failed to add {} to /boot/crypto_keyfile.bin".format(
-                                part["luksMapperName"]
-                            )
-                        ),
-                    )
+                    ),
+                )
 
     status = _("Configuring NixOS")
     libcalamares.job.setprogress(0.18)
 
-    cfg += cfgnetwork
-    cfg += cfgnetworkmanager
+    cfg_parts.append(cfgnetwork)
+    cfg_parts.append(cfgnetworkmanager)
 
-    if gs.value("hostname") is None:
+    hostname = gs.value("hostname")
+    if hostname is None:
         catenate(variables, "hostname", "nixos")
     else:
-        catenate(variables, "hostname", gs.value("hostname"))
-
-    if gs.value("locationRegion") is not None and gs.value("locationZone") is not None:
-        cfg += cfgtime
-        catenate(
-            variables,
-            "timezone",
-            gs.value("locationRegion"),
-            "/",
-            gs.value("locationZone"),
-        )
+        catenate(variables, "hostname", hostname)
 
-    if gs.value("localeConf") is not None:
-        localeconf = gs.value("localeConf")
+    location_region = gs.value("locationRegion")
+    location_zone = gs.value("locationZone")
+    if location_region is not None and location_zone is not None:
+        cfg_parts.append(cfgtime)
+        catenate(variables, "timezone", location_region, "/", location_zone)
+
+    localeconf = gs.value("localeConf")
+    if localeconf is not None:
         locale = localeconf.pop("LANG").split("/")[0]
-        cfg += cfglocale
+        cfg_parts.append(cfglocale)
         catenate(variables, "LANG", locale)
         if (
             len(set(localeconf.values())) != 1
             or list(set(localeconf.values()))[0] != locale
         ):
-            cfg += cfglocaleextra
+            cfg_parts.append(cfglocaleextra)
             for conf in localeconf:
                 catenate(variables, conf, localeconf.get(conf).split("/")[0])
 
     # Choose desktop environment
-    cfg += cfgplasma6
-
-    if (
-        gs.value("keyboardLayout") is not None
-        and gs.value("keyboardVariant") is not None
-    ):
-        cfg += cfgkeymap
-        catenate(variables, "kblayout", gs.value("keyboardLayout"))
-        catenate(variables, "kbvariant", gs.value("keyboardVariant"))
-
-        if gs.value("keyboardVConsoleKeymap") is not None:
-            try:
-                subprocess.check_output(
-                    ["pkexec", "loadkeys", gs.value("keyboardVConsoleKeymap").strip()],
-                    stderr=subprocess.STDOUT,
-                )
-                cfg += cfgconsole
-                catenate(
-                    variables, "vconsole", gs.value("keyboardVConsoleKeymap").strip()
-                )
-            except subprocess.CalledProcessError as e:
-                libcalamares.utils.error("loadkeys: {}".format(e.output))
+    cfg_parts.append(cfgplasma6)
+
+    kblayout = gs.value("keyboardLayout")
+    kbvariant = gs.value("keyboardVariant")
+    vconsole_keymap = gs.value("keyboardVConsoleKeymap")
+    if kblayout is not None and kbvariant is not None:
+        cfg_parts.append(cfgkeymap)
+        catenate(variables, "kblayout", kblayout)
+        catenate(variables, "kbvariant", kbvariant)
+
+        if vconsole_keymap is not None:
+            if keymap_is_valid(vconsole_keymap.strip()):
+                cfg_parts.append(cfgconsole)
+                catenate(variables, "vconsole", vconsole_keymap.strip())
+            else:
                 libcalamares.utils.error(
                     "Setting vconsole keymap to {} will fail, using default".format(
-                        gs.value("keyboardVConsoleKeymap").strip()
+                        vconsole_keymap.strip()
                     )
                 )
         else:
-            kbdmodelmap = open(
+            # Find rows with same layout while reading the map
+            with open(
                 "/run/current-system/sw/share/systemd/kbd-model-map", "r"
-            )
-            kbd = kbdmodelmap.readlines()
-            out = []
-            for line in kbd:
-                if line.startswith("#"):
-                    continue
-                out.append(line.split())
-            # Find rows with same layout
-            find = []
-            for row in out:
-                if gs.value("keyboardLayout") == row[1]:
-                    find.append(row)
-            if find != []:
-                vconsole = find[0][0]
-            else:
-                vconsole = ""
-            if gs.value("keyboardVariant") is not None:
-                variant = gs.value("keyboardVariant")
+            ) as kbdmodelmap:
+                find = [
+                    row
+                    for row in (
+                        line.split()
+                        for line in kbdmodelmap
+                        if not line.startswith("#")
+                    )
+                    if len(row) > 3 and row[1] == kblayout
+                ]
+            if kbvariant is not None:
+                variant = kbvariant
             else:
                 variant = "-"
-            # Find rows with same variant
-            for row in find:
-                if variant in row[3]:
-                    vconsole = row[0]
-                    break
-                # If none found set to "us"
+            # Prefer the first row with same variant, else the first row with same layout
+            vconsole = next(
+                (row[0] for row in find if variant in row[3]),
+                find[0][0] if find else "",
+            )
+            # If none found set to "us"
             if vconsole != "" and vconsole != "us" and vconsole is not None:
-                try:
-                    subprocess.check_output(
-                        ["pkexec", "loadkeys", vconsole], stderr=subprocess.STDOUT
-                    )
-                    cfg += cfgconsole
+                if keymap_is_valid(vconsole):
+                    cfg_parts.append(cfgconsole)
                     catenate(variables, "vconsole", vconsole)
-                except subprocess.CalledProcessError as e:
-                    libcalamares.utils.error("loadkeys: {}".format(e.output))
+                else:
                     libcalamares.utils.error("vconsole value: {}".format(vconsole))
                     libcalamares.utils.error(
                         "Setting vconsole keymap to {} will fail, using default".format(
-                            gs.value("keyboardVConsoleKeymap")
+                            vconsole_keymap
                         )
                     )
 
-    cfg += cfgmisc
+    cfg_parts.append(cfgmisc)
 
-    if gs.value("username") is not None:
+    username = gs.value("username")
+    if username is not None:
         fullname = gs.value("fullname")
         groups = ["networkmanager", "wheel"]
 
-        cfg += cfgusers
-        catenate(variables, "username", gs.value("username"))
+        cfg_parts.append(cfgusers)
+        catenate(variables, "username", username)
         catenate(variables, "fullname", fullname)
         catenate(variables, "groups", (" ").join(['"' + s + '"' for s in groups]))
-        if (
-            gs.value("autoLoginUser") is not None
-            and gs.value("packagechooser_packagechooser") is not None
-            and gs.value("packagechooser_packagechooser") != ""
-        ):
-            cfg += cfgautologin
-            if gs.value("packagechooser_packagechooser") == "gnome":
-                cfg += cfgautologingdm
-        elif gs.value("autoLoginUser") is not None:
-            cfg += cfgautologintty
-
-    cfg += cfgpkgs
-    cfg += cfgtail
-    
-    version = ".".join(subprocess.getoutput(["nixos-version"]).split(".")[:2])[:5]
-    catenate(variables, "nixosversion", version)
+        autologin_user = gs.value("autoLoginUser")
+        desktop = gs.value("packagechooser_packagechooser")
+        if autologin_user is not None and desktop is not None and desktop != "":
+            cfg_parts.append(cfgautologin)
+            if desktop == "gnome":
+                cfg_parts.append(cfgautologingdm)
+        elif autologin_user is not None:
+            cfg_parts.append(cfgautologintty)
+
+    cfg_parts.append(cfgpkgs)
+    cfg_parts.append(cfgtail)
+    cfg = "".join(cfg_parts)
 
-    # Check that all variables are used
-    for key in variables.keys():
-        pattern = "@@{key}@@".format(key=key)
-        if pattern not in cfg:
-            libcalamares.utils.warning("Variable '{key}' is not used.".format(key=key))
-
-    # Check that all patterns exist
-    variable_pattern = re.compile(r"@@\w+@@")
-    for match in variable_pattern.finditer(cfg):
-        variable_name = cfg[match.start() + 2 : match.end() - 2]
-        if variable_name not in variables:
-            libcalamares.utils.warning(
-                "Variable '{key}' is used but not defined.".format(key=variable_name)
-            )
+    try:
+        with open("/run/current-system/nixos-version", "r") as nixosversion:
+            nixos_version = nixosversion.read()
+    except FileNotFoundError:
+        nixos_version = subprocess.check_output(["nixos-version"], text=True)
+    version = ".".join(nixos_version.strip().split(".")[:2])[:5]
+    catenate(variables, "nixosversion", version)
 
-    # Do the substitutions
-    for key in variables.keys():
-        pattern = "@@{key}@@".format(key=key)
-        cfg = cfg.replace(pattern, str(variables[key]))
+    # Do the substitutions, checking that all variables and patterns match up
+    cfg = render(cfg, variables)
 
     status = _("Generating NixOS configuration")
     libcalamares.job.setprogress(0.25)
@@ -1953,56 +2115,43 @@ def run():
         return (_("nixos-generate-config failed"), _(e.output.decode("utf8")))
 
     # Check for unfree stuff in hardware-configuration.nix
-    hf = open(root_mount_point + "/etc/nixos/hardware-configuration.nix", "r")
-    htxt = hf.read()
-    search = re.search(r"boot\.extraModulePackages = \[ (.*) \];", htxt)
+    hwconf = root_mount_point + "/etc/nixos/hardware-configuration.nix"
+    with open(hwconf, "r") as hf:
+        htxt = hf.read()
+    search = extra_module_packages_pattern.search(htxt)
+
+    # Only free packages are allowed if the user picked them in the unfree page
+    free = gs.value("packagechooser_unfree") == "free"
 
     # Check if any extraModulePackages are defined, and remove if only free packages are allowed
     if search is not None and free:
         expkgs = search.group(1).split(" ")
+        unfree = unfree_kernel_packages(
+            [".".join(pkg.split(".")[3:]) for pkg in expkgs]
+        )
+        freepkgs = []
         for pkg in expkgs:
             p = ".".join(pkg.split(".")[3:])
-            # Check package p is unfree
-            isunfree = subprocess.check_output(
-                [
-                    "nix-instantiate",
-                    "--eval",
-                    "--strict",
-                    "-E",
-                    "with import <nixpkgs> {{}}; pkgs.linuxKernel.packageAliases.linux_default.{}.meta.unfree".format(
-                        p
-                    ),
-                    "--json",
-                ],
-                stderr=subprocess.STDOUT,
-            )
-            if isunfree == b"true":
+            if unfree[p]:
                 libcalamares.utils.warning(
                     "{} is marked as unfree, removing from hardware-configuration.nix".format(
                         p
                     )
                 )
-                expkgs.remove(pkg)
-        hardwareout = re.sub(
-            r"boot\.extraModulePackages = \[ (.*) \];",
+            else:
+                freepkgs.append(pkg)
+        expkgs = freepkgs
+        hardwareout = extra_module_packages_pattern.sub(
             "boot.extraModulePackages = [ {}];".format(
-                "".join(map(lambda x: x + " ", expkgs))
+                " ".join(expkgs) + " " if expkgs else ""
             ),
             htxt,
         )
         # Write the hardware-configuration.nix file
-        libcalamares.utils.host_env_process_output(
-            [
-                "cp",
-                "/dev/stdin",
-                root_mount_point + "/etc/nixos/hardware-configuration.nix",
-            ],
-            None,
-            hardwareout,
-        )
+        write_file(hwconf, hardwareout)
 
     # Write the configuration.nix file
-    libcalamares.utils.host_env_process_output(["cp", "/dev/stdin", config], None, cfg)
+    write_file(config, cfg)
 
     status = _("Installing NixOS")
     libcalamares.job.setprogress(0.3)
@@ -2021,21 +2170,20 @@ def run():
 
     # Install customizations
     try:
-        output = ""
+        output = []
         proc = subprocess.Popen(
             nixosInstallCmd,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+            errors="replace",
         )
-        while True:
-            line = proc.stdout.readline().decode("utf-8")
-            output += line
+        for line in proc.stdout:
+            output.append(line)
             libcalamares.utils.debug("nixos-install: {}".format(line.strip()))
-            if not line:
-                break
         exit = proc.wait()
         if exit != 0:
-            return (_("nixos-install failed"), _(output))
+            return (_("nixos-install failed"), _("".join(output)))
     except:
         return (_("nixos-install failed"), _("Installation failed to complete"))
 
@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 
@@ -28,6 +29,20 @@ def globalstorage():
         "firmwareType": "efi",
         "partitions": [],
         "keyboardLayout": "us",
+        "locationRegion": "America",
+        "locationZone": "New_York",
+        "localeConf": {
+            "LANG": "en_US.UTF-8",
+            "LC_ADDRESS": "en_US.UTF-8",
+            "LC_IDENTIFICATION": "en_US.UTF-8",
+            "LC_MEASUREMENT": "en_US.UTF-8",
+            "LC_MONETARY": "en_US.UTF-8",
+            "LC_NAME": "en_US.UTF-8",
+            "LC_NUMERIC": "en_US.UTF-8",
+            "LC_PAPER": "en_US.UTF-8",
+            "LC_TELEPHONE": "en_US.UTF-8",
+            "LC_TIME": "en_US.UTF-8",
+        },
         "username": "username",
         "fullname": "fullname",
     }
@@ -38,24 +53,11 @@ def mock_check_output(mocker):
     return mocker.Mock(name="subprocess.check_output")
 
 
-@pytest.fixture
-def mock_getoutput(mocker):
-    return mocker.Mock(
-        name="subprocess.getoutput",
-        # subprocess.getoutput() is only called to get the output of `nixos-version` so it is hard-coded here.
-        return_value="24.05.20240815.c3d4ac7 (Uakari)",
-    )
-
-
 @pytest.fixture
 def mock_Popen(mocker):
     mock_Popen_inst = mocker.Mock("Popen()")
-    mock_Popen_inst.stdout = mocker.Mock("Popen().stdout")
-    mock_Popen_inst.stdout.readline = mocker.Mock(
-        "Popen().stdout.readline",
-        # Make Popen print nothing (empty bytes) to stdout
-        return_value=b"",
-    )
+    # Make Popen print nothing to stdout
+    mock_Popen_inst.stdout = io.StringIO("")
     mock_Popen_inst.wait = mocker.Mock(
         "Popen().wait",
         # Make Popen().wait() give a returncode of 0
@@ -64,6 +66,34 @@ def mock_Popen(mocker):
     return mocker.Mock(name="subprocess.Popen", return_value=mock_Popen_inst)
 
 
+@pytest.fixture
+def mock_os_open(mocker):
+    return mocker.Mock(
+        name="os.open",
+        # Hand out a made-up file descriptor
+        return_value=3,
+    )
+
+
+@pytest.fixture
+def mock_os_write(mocker):
+    return mocker.Mock(
+        name="os.write",
+        # Pretend that everything passed to os.write() was written
+        side_effect=lambda fd, data: len(data),
+    )
+
+
+@pytest.fixture
+def mock_os_makedirs(mocker):
+    return mocker.Mock(name="os.makedirs")
+
+
+@pytest.fixture
+def mock_os_chmod(mocker):
+    return mocker.Mock(name="os.chmod")
+
+
 @pytest.fixture
 def mock_libcalamares(mocker, globalstorage):
     mock_libcalamares = mocker.Mock("libcalamares")
@@ -83,6 +113,7 @@ def mock_libcalamares(mocker, globalstorage):
         "libcalamares.utils.gettext_languages"
     )
     mock_libcalamares.utils.warning = mocker.Mock("libcalamares.utils.warning")
+    mock_libcalamares.utils.error = mocker.Mock("libcalamares.utils.error")
     mock_libcalamares.utils.debug = mocker.Mock("libcalamares.utils.debug")
     mock_libcalamares.utils.host_env_process_output = mocker.Mock(
         "libcalamares.utils.host_env_process_output"
@@ -105,12 +136,27 @@ def mock_open_kbdmodelmap(mocker):
 
 
 @pytest.fixture
-def mock_open(mocker, mock_open_hwconf, mock_open_kbdmodelmap):
+def mock_open_nixosversion(mocker):
+    return mocker.Mock('open("nixos-version")')
+
+
+@pytest.fixture
+def hwconf_txt():
     testing_dir = os.path.dirname(__file__)
 
-    hwconf_txt = ""
     with open(os.path.join(testing_dir, "hardware-configuration.nix"), "r") as hwconf:
-        hwconf_txt = hwconf.read()
+        return hwconf.read()
+
+
+@pytest.fixture
+def mock_open(
+    mocker,
+    hwconf_txt,
+    mock_open_hwconf,
+    mock_open_kbdmodelmap,
+    mock_open_nixosversion,
+):
+    testing_dir = os.path.dirname(__file__)
 
     kbdmodelmap_txt = ""
     with open(os.path.join(testing_dir, "kbd-model-map"), "r") as kbdmodelmap:
@@ -129,6 +175,12 @@ def mock_open(mocker, mock_open_hwconf, mock_open_kbdmodelmap):
             return mocker.mock_open(
                 mock=mock_open_kbdmodelmap, read_data=kbdmodelmap_txt
             )(*args)
+        elif file.endswith("nixos-version"):
+            return mocker.mock_open(
+                mock=mock_open_nixosversion,
+                # The version of the running system is hard-coded here.
+                read_data="24.05.20240815.c3d4ac7",
+            )(*args)
         else:
             raise AssertionError(f"open() called with unexpected file '{file}'")
 
@@ -143,20 +195,31 @@ def run(
     mock_gettext_translation,
     mock_libcalamares,
     mock_check_output,
-    mock_getoutput,
     mock_Popen,
     mock_open,
+    mock_os_open,
+    mock_os_write,
+    mock_os_makedirs,
+    mock_os_chmod,
 ):
     sys.modules["libcalamares"] = mock_libcalamares
 
     mocker.patch("gettext.translation", mock_gettext_translation)
 
     mocker.patch("subprocess.check_output", mock_check_output)
-    mocker.patch("subprocess.getoutput", mock_getoutput)
     mocker.patch("subprocess.Popen", mock_Popen)
 
     mocker.patch("builtins.open", mock_open)
 
+    mocker.patch("os.makedirs", mock_os_makedirs)
+    mocker.patch("os.chmod", mock_os_chmod)
+    mocker.patch("os.open", mock_os_open)
+    mocker.patch("os.fchmod")
+    mocker.patch("os.write", mock_os_write)
+    mocker.patch("os.close")
+
+    # Import the module afresh so it binds this test's mocks
+    sys.modules.pop("modules.nixos.main", None)
     from modules.nixos.main import run
 
     return run
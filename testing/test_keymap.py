@@ -0,0 +1,83 @@
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def globalstorage(globalstorage):
+    # kbd-model-map maps de/nodeadkeys to de-latin1-nodeadkeys
+    globalstorage["keyboardLayout"] = "de"
+    globalstorage["keyboardVariant"] = "nodeadkeys"
+    return globalstorage
+
+
+def written_cfg(mock_os_write):
+    return b"".join(
+        bytes(call.args[1]) for call in mock_os_write.mock_calls
+    ).decode("utf-8")
+
+
+def localectl_lists(keymaps):
+    def fake_check_output(cmd, *args, **kwargs):
+        if cmd == ["localectl", "list-keymaps"]:
+            return "\n".join(keymaps) + "\n"
+        return b""
+
+    return fake_check_output
+
+
+def test_keymap_listed(
+    mocker, run, mock_libcalamares, mock_check_output, mock_os_write
+):
+    mock_check_output.side_effect = localectl_lists(
+        ["de", "de-latin1", "de-latin1-nodeadkeys", "us"]
+    )
+
+    assert run() is None, "nixos-install failed."
+
+    mock_check_output.assert_any_call(
+        ["localectl", "list-keymaps"], stderr=subprocess.DEVNULL, text=True
+    )
+    # The keymap is not test-loaded when localectl knows it
+    assert mocker.call(
+        ["pkexec", "loadkeys", "de-latin1-nodeadkeys"], stderr=subprocess.STDOUT
+    ) not in mock_check_output.mock_calls
+    mock_libcalamares.utils.error.assert_not_called()
+    assert (
+        'console.keyMap = "de-latin1-nodeadkeys";' in written_cfg(mock_os_write)
+    )
+
+
+def test_keymap_not_listed(
+    mocker, run, mock_libcalamares, mock_check_output, mock_os_write
+):
+    mock_check_output.side_effect = localectl_lists(["de", "us"])
+
+    assert run() is None, "nixos-install failed."
+
+    mock_libcalamares.utils.error.assert_any_call(
+        "vconsole value: de-latin1-nodeadkeys"
+    )
+    assert "console.keyMap" not in written_cfg(mock_os_write)
+
+
+def test_keymap_without_localectl(
+    mocker, run, mock_libcalamares, mock_check_output, mock_os_write
+):
+    def fake_check_output(cmd, *args, **kwargs):
+        if cmd[0] == "localectl":
+            raise FileNotFoundError(cmd[0])
+        return b""
+
+    mock_check_output.side_effect = fake_check_output
+
+    assert run() is None, "nixos-install failed."
+
+    # Fall back to test-loading the keymap
+    mock_check_output.assert_any_call(
+        ["pkexec", "loadkeys", "de-latin1-nodeadkeys"], stderr=subprocess.STDOUT
+    )
+    mock_libcalamares.utils.error.assert_not_called()
+    assert (
+        'console.keyMap = "de-latin1-nodeadkeys";' in written_cfg(mock_os_write)
+    )
@@ -0,0 +1,130 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def globalstorage(globalstorage):
+    globalstorage["firmwareType"] = "bios"
+    globalstorage["bootLoader"] = {"installPath": "/dev/vda"}
+    globalstorage["partitions"] = [
+        {
+            "claimed": True,
+            "device": "/dev/vda1",
+            "fs": "linuxswap",
+            "fsName": "luks2",
+            "luksMapperName": "luks-swap",
+            "luksPassphrase": "passphrase",
+            "mountPoint": "",
+            "uuid": "1111",
+        },
+        {
+            "claimed": True,
+            "device": "/dev/vda2",
+            "fs": "ext4",
+            "fsName": "luks2",
+            "luksMapperName": "luks-root",
+            "luksPassphrase": "passphrase",
+            "mountPoint": "/",
+            "uuid": "2222",
+        },
+        {
+            "claimed": True,
+            "device": "/dev/vda3",
+            "fs": "ext4",
+            "fsName": "luks",
+            "luksMapperName": "luks-home",
+            "luksPassphrase": "passphrase",
+            "mountPoint": "/home",
+            "uuid": "3333",
+        },
+    ]
+    return globalstorage
+
+
+@pytest.fixture
+def mock_check_output(mocker):
+    def fake_check_output(cmd, *args, **kwargs):
+        if cmd[:2] == ["cryptsetup", "luksDump"]:
+            # /dev/vda2 already uses pbkdf2, /dev/vda1 cannot be dumped
+            if cmd[-1] != "/dev/vda2":
+                raise subprocess.CalledProcessError(1, cmd)
+            return json.dumps(
+                {
+                    "keyslots": {
+                        "0": {"kdf": {"type": "pbkdf2"}},
+                        "1": {"kdf": {"type": "pbkdf2"}},
+                    }
+                }
+            ).encode("utf-8")
+        return b""
+
+    return mocker.Mock(name="subprocess.check_output", side_effect=fake_check_output)
+
+
+def test_luks_keyfile(
+    mocker,
+    run,
+    mock_libcalamares,
+    mock_check_output,
+    mock_os_open,
+    mock_os_write,
+    mock_os_makedirs,
+    mock_os_chmod,
+):
+    result = run()
+
+    assert result is None, "nixos-install failed."
+
+    # /boot is created (or tightened) with mode 0700
+    mock_os_makedirs.assert_called_once_with(
+        "/mnt/root/boot", mode=0o700, exist_ok=True
+    )
+    mock_os_chmod.assert_called_once_with("/mnt/root/boot", 0o700)
+
+    # write_file(keyfile, os.urandom(2048), 0o600)
+    assert mock_os_open.mock_calls[0] == mocker.call(
+        "/mnt/root/boot/crypto_keyfile.bin",
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o600,
+    )
+    assert len(bytes(mock_os_write.mock_calls[0].args[1])) == 2048
+
+    # The key slots of every LUKS2 device are checked, LUKS1 is always pbkdf2
+    assert [
+        call.args[0]
+        for call in mock_check_output.mock_calls
+        if call.args[0][:2] == ["cryptsetup", "luksDump"]
+    ] == [
+        ["cryptsetup", "luksDump", "--dump-json-metadata", "/dev/vda1"],
+        ["cryptsetup", "luksDump", "--dump-json-metadata", "/dev/vda2"],
+    ]
+
+    cryptsetup = [
+        call.args[0]
+        for call in mock_libcalamares.utils.host_env_process_output.mock_calls
+        if call.args[0][0] == "cryptsetup"
+    ]
+
+    # luksConvertKey only runs where luksDump failed, not on pbkdf2 slots
+    # and never on LUKS1, where cryptsetup does not support it
+    assert [cmd[-1] for cmd in cryptsetup if cmd[1] == "luksConvertKey"] == [
+        "/dev/vda1"
+    ]
+
+    # luksAddKey runs once per LUKS device
+    assert [cmd for cmd in cryptsetup if cmd[1] == "luksAddKey"] == [
+        [
+            "cryptsetup",
+            "luksAddKey",
+            "--hash",
+            "sha256",
+            "--pbkdf",
+            "pbkdf2",
+            device,
+            "/mnt/root/boot/crypto_keyfile.bin",
+        ]
+        for device in ("/dev/vda1", "/dev/vda2", "/dev/vda3")
+    ]
@@ -0,0 +1,93 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def globalstorage(globalstorage):
+    globalstorage["packagechooser_unfree"] = "free"
+    return globalstorage
+
+
+@pytest.fixture
+def hwconf_txt(hwconf_txt):
+    # Two adjacent unfree modules followed by a free one
+    return hwconf_txt.replace(
+        "boot.extraModulePackages = [ ];",
+        "boot.extraModulePackages = [ "
+        "config.boot.kernelPackages.broadcom_sta "
+        "config.boot.kernelPackages.nvidia_x11 "
+        "config.boot.kernelPackages.acpi_call ];",
+    )
+
+
+@pytest.fixture
+def mock_check_output(mocker):
+    def fake_check_output(cmd, *args, **kwargs):
+        if cmd[0] == "nix-instantiate":
+            return json.dumps(
+                {"broadcom_sta": True, "nvidia_x11": True, "acpi_call": False}
+            ).encode("utf-8")
+        return b""
+
+    return mocker.Mock(name="subprocess.check_output", side_effect=fake_check_output)
+
+
+def test_unfree_modules_removed(
+    mocker,
+    run,
+    hwconf_txt,
+    mock_libcalamares,
+    mock_check_output,
+    mock_os_open,
+    mock_os_write,
+):
+    result = run()
+
+    assert result is None, "nixos-install failed."
+
+    # All extraModulePackages are checked with one nix-instantiate call
+    nix_instantiate = [
+        call
+        for call in mock_check_output.mock_calls
+        if call.args[0][0] == "nix-instantiate"
+    ]
+    assert len(nix_instantiate) == 1
+    expression = nix_instantiate[0].args[0][4]
+    for pkg in ("broadcom_sta", "nvidia_x11", "acpi_call"):
+        assert '"{}" ='.format(pkg) in expression
+
+    # Both unfree modules are reported
+    mock_libcalamares.utils.warning.assert_has_calls(
+        [
+            mocker.call(
+                "broadcom_sta is marked as unfree, removing from hardware-configuration.nix"
+            ),
+            mocker.call(
+                "nvidia_x11 is marked as unfree, removing from hardware-configuration.nix"
+            ),
+        ]
+    )
+
+    # write_file(hwconf, hardwareout) comes first, then configuration.nix
+    assert mock_os_open.mock_calls[0] == mocker.call(
+        "/mnt/root/etc/nixos/hardware-configuration.nix",
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o644,
+    )
+    assert mock_os_open.mock_calls[1] == mocker.call(
+        "/mnt/root/etc/nixos/configuration.nix",
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o644,
+    )
+    hwconf = bytes(mock_os_write.mock_calls[0].args[1]).decode("utf-8")
+    assert hwconf == hwconf_txt.replace(
+        "config.boot.kernelPackages.broadcom_sta "
+        "config.boot.kernelPackages.nvidia_x11 ",
+        "",
+    )
+    assert (
+        "boot.extraModulePackages = [ config.boot.kernelPackages.acpi_call ];"
+        in hwconf
+    )